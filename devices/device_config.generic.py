@@ -34,6 +34,10 @@ class DeviceConfig:
             'cs': 12,
             'xres': 240,
             'yres': 240,
+            # Set to True on devices with plenty of RAM (PSRAM) to
+            # send each display update with a single SPI write. It
+            # needs a full RGB565 frame: xres*yres*2 bytes.
+            'full_frame': False,
         }
 
     ########################### PMU CONFIGURATION ##########################
@@ -98,6 +102,8 @@ class DeviceConfig:
     ########################### LORA CONFIGURATION #########################
 
     # Pin configuration for the SX1276.
+    # Like for the SX1262 below, 'spi_channel' can optionally be set
+    # in order to use the hardware SPI.
     if False:
         config['sx1276'] = {
             'miso': 19,
@@ -109,6 +115,9 @@ class DeviceConfig:
         }
 
     # Pin configuration for the SX1262.
+    # Optionally 'spi_channel' can be set to the hardware SPI peripheral
+    # to use (make sure it is not already used by the display), otherwise
+    # software SPI is used.
     if False:
         config['sx1262'] = {
             'busy': 7,
@@ -11,7 +11,7 @@ class DeviceConfig:
         'polarity': 1,
         'phase': 1,
         'xstart': 0,
-        'ystart': 40,
+        'ystart': 80,
         'sck': 18,
         'mosi': 13,
         'miso': 37,
@@ -24,7 +24,8 @@ class DeviceConfig:
         'landscape': False,
         'mirror_y': True,
         'mirror_x': True,
-        'inversion': True
+        'inversion': True,
+        'full_frame': True # The T-WATCH S3 has 8MB of PSRAM.
     }
 
     # AXP2101 PMU. In the T-WATCH S3 this chip handles the different
@@ -47,7 +47,7 @@ class SX1276Example:
             self.display.fill(0)
             self.display.text(payload, 0, 0, 1)
             self.display.show()
-            self.lora.send(payload)
+            self.lora.send(payload.encode())
             time.sleep(5) 
 
 example = SX1276Example()
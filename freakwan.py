@@ -147,7 +147,7 @@ class FreakWAN:
                 cs = Pin(cfg['cs'], Pin.OUT) if isinstance(cfg['cs'],int) else None
             )
             self.display.init(xstart=cfg['xstart'],ystart=cfg['ystart'],landscape=cfg['landscape'],mirror_y=cfg['mirror_y'],mirror_x=cfg['mirror_x'],inversion=cfg['inversion'])
-            self.display.enable_framebuffer(mono=True)
+            self.display.enable_framebuffer(mono=True,full_frame=cfg.get('full_frame',False))
             self.display.line = self.display.fb.line
             self.display.pixel = self.display.fb.pixel
             self.display.text = self.display.fb.text
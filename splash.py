@@ -4,7 +4,7 @@
 # This code is released under the BSD 2 clause license.
 # See the LICENSE file for more information
 
-import math
+import math, array, framebuf
 
 # This class implements the view that shows the splash screen on startup.
 class SplashScreen:
@@ -14,16 +14,65 @@ class SplashScreen:
         self.yres = yres
         self.anim_frame = 0     # Animation frame to show
 
+        # The waves animation used to call math.sin() for every pixel.
+        # We use instead a 256 entries table for a full period, already
+        # scaled by the wave amplitude (4 pixels). Angles are expressed
+        # in table steps, that is 256/(2*pi) steps per radiant.
+        self.sin_lut = array.array('b',[int(math.sin(i*2*math.pi/256)*4) for i in range(256)])
+
+        # For each row of waves (one every 8 pixels) we precompute the
+        # x phase increment, in table steps, as fixed point with 10 bits
+        # of fractional part: 41722 is 256/(2*pi)*1024.
+        self.wave_steps = array.array('H',[41722//(1+(y*17%11)) for y in range(0,yres+8,8)])
+
     def next_frame(self):
         self.anim_frame += 1
 
+    # Return the display raw mono framebuffer memory and its layout
+    # (1 for MONO_VLSB, 0 for MONO_HMSB), or None if the display does not
+    # expose it. The SSD1306 driver is itself a MONO_VLSB framebuffer,
+    # while the ST7789 driver uses a MONO_HMSB one when in mono mode.
+    def get_raw_fb(self):
+        d = self.display
+        if getattr(d,'fbformat',None) == framebuf.MONO_HMSB:
+            return d.rawbuffer, 0
+        if isinstance(d,framebuf.FrameBuffer) and hasattr(d,'buffer'):
+            return d.buffer, 1
+        return None
+
+    # Viper version of the waves drawing loop, see draw_logo(). Pixels
+    # are stamped directly into the framebuffer memory using integer
+    # math only, so there are no method calls per pixel.
+    @micropython.viper
+    def draw_waves(self, fb: ptr8, xres: int, yres: int, phase: int, vlsb: int):
+        sin_lut = ptr8(self.sin_lut)
+        steps = ptr16(self.wave_steps)
+        rows = int(len(self.wave_steps))
+        for row in range(rows):
+            y = row << 3
+            step = int(steps[row])
+            x = 0
+            while x < xres:
+                dy = int(sin_lut[(phase+((x*step)>>10))&0xff])
+                if dy > 127: dy -= 256 # Table is signed.
+                py = y+dy
+                if py >= 0 and py < yres:
+                    if vlsb:
+                        idx = (py>>3)*xres+x
+                        fb[idx] = fb[idx] | (1 << (py&7))
+                    else:
+                        bit = py*xres+x
+                        fb[bit>>3] = fb[bit>>3] | (1 << (bit&7))
+                x += 2
+
     def draw_logo(self):
         self.display.fill(0)
-        for x in range(0,self.xres,2):
-            for y in range(0,self.yres+8,8):
-                f1 = self.anim_frame/5
-                dy = math.sin(f1+x/(1+(y*17%11)))*4
-                self.display.pixel(int(x),y+int(dy),1)
+        phase = (self.anim_frame*8344)>>10 # frame/5 radiants, in table steps.
+        raw = self.get_raw_fb()
+        if raw:
+            self.draw_waves(raw[0],self.xres,self.yres,phase,raw[1])
+        else:
+            self.draw_waves_slow(phase)
         dx = 15
         dy = 8 
         self.display.fill_rect(dx+0,dy+0,40,10,0);
@@ -42,6 +91,17 @@ class SplashScreen:
         self.display.line(dx,dy,dx+15,dy+50,1)
         self.display.line(dx+30,dy,dx+45,dy+50,1)
 
+    # Draw the waves using the display pixel() method. Used when we
+    # can't access the framebuffer memory directly.
+    def draw_waves_slow(self, phase):
+        pixel = self.display.pixel
+        sin_lut = self.sin_lut
+        y = 0
+        for step in self.wave_steps:
+            for x in range(0,self.xres,2):
+                pixel(x,y+sin_lut[(phase+((x*step)>>10))&0xff],1)
+            y += 8
+
     def refresh(self):
         if not self.display: return
         self.draw_logo()
@@ -49,6 +49,15 @@ ColorMode_16M = const(0x07)
 # Struct pack formats for pixel/pos encoding
 _ENCODE_PIXEL = ">H"
 _ENCODE_POS = ">HH"
+_ENCODE_WINDOW = ">HHHH"
+
+# Cache of the colors returned by color(), keyed by r<<16|g<<8|b, that
+# is a small int and requires no allocation. Applications use just a
+# few colors, so this avoids a struct.pack() allocation for every
+# call. The cache is flushed when it reaches _COLOR_CACHE_MAX entries,
+# so that generating many different colors can't use unbounded memory.
+_COLOR_CACHE = {}
+_COLOR_CACHE_MAX = const(32)
 
 class ST7789_base:
     def __init__(self, spi, width, height, reset, dc, cs=None):
@@ -75,12 +84,42 @@ class ST7789_base:
         self.charfb_data = bytearray(8*8*2)
         self.charfb = framebuf.FrameBuffer(self.charfb_data,8,8,framebuf.RGB565)
 
+        # Display-wide 8 pixels tall buffer, so that text() can render
+        # a whole string and send it with a single window setup and SPI
+        # write, instead of doing it per char. Allocated at the first
+        # text() call, since applications drawing text via the
+        # framebuffer never need it.
+        self.strfb_data = None
+
+        # Buffer used by pixel() to encode the window position without
+        # allocating a new bytes object for each SPI write.
+        self.posbuf = bytearray(4)
+
+        # Same for set_window(), that encodes columns and rows range
+        # at once, and then sends the two halves.
+        self.winbuf = bytearray(8)
+        self.winbuf_cols = memoryview(self.winbuf)[:4]
+        self.winbuf_rows = memoryview(self.winbuf)[4:]
+
+        # A scanline of pixels all of the same color, used by fill(),
+        # rect() and lines drawing. It is long enough for both rows and
+        # columns, and it is only rewritten when the color changes.
+        self.scanline = bytearray(max(width,height)*2)
+        self.scanline_mv = memoryview(self.scanline)
+        self.scanline_color = None
+
     # That's the color format our API takes. We take r, g, b, translate
     # to 16 bit value and pack it as as two bytes.
     def color(self, r=0, g=0, b=0):
-        # Convert red, green and blue values (0-255) into a 16-bit 565 encoding.
-        c = (r & 0xf8) << 8 | (g & 0xfc) << 3 | b >> 3
-        return struct.pack(_ENCODE_PIXEL, c)
+        key = r<<16 | g<<8 | b
+        c = _COLOR_CACHE.get(key)
+        if c is None:
+            # Convert red, green and blue values (0-255) into a 16-bit 565 encoding.
+            c = (r & 0xf8) << 8 | (g & 0xfc) << 3 | b >> 3
+            c = struct.pack(_ENCODE_PIXEL, c)
+            if len(_COLOR_CACHE) >= _COLOR_CACHE_MAX: _COLOR_CACHE.clear()
+            _COLOR_CACHE[key] = c
+        return c
 
     def write(self, command=None, data=None):
         """SPI write to the device: commands and data"""
@@ -136,7 +175,7 @@ class ST7789_base:
         elif (self.width, self.height) == (240, 240):
             self.xstart = 0
             self.ystart = 0
-            if self.mirror_y: self.ystart = 40
+            if self.mirror_y: self.ystart = 80 # 320 rows RAM, 240 visible.
         elif (self.width, self.height) == (135, 240):
             self.xstart = 52
             self.ystart = 40
@@ -172,45 +211,64 @@ class ST7789_base:
         if is_bgr: value |= ST7789_MADCTL_BGR
         self.write(ST7789_MADCTL, bytes([value]))
 
-    def _encode_pos(self, x, y):
-        """Encode a postion into bytes."""
-        return struct.pack(_ENCODE_POS, x, y)
-
-    def _set_columns(self, start, end):
-        self.write(ST77XX_CASET, self._encode_pos(start+self.xstart, end+self.xstart))
-
-    def _set_rows(self, start, end):
-        start += self.ystart
-        end += self.ystart
-        self.write(ST77XX_RASET, self._encode_pos(start+self.ystart, end+self.ystart))
-
     # Set the video memory windows that will be receive our
     # SPI data writes. Note that this function assumes that
     # x0 <= x1 and y0 <= y1.
+    #
+    # This is called for every drawing operation, so we encode both
+    # the ranges with a single struct.pack_into() and do the SPI
+    # writes inline, instead of going through write() for each
+    # command.
     def set_window(self, x0, y0, x1, y1):
-        self._set_columns(x0, x1)
-        self._set_rows(y0, y1)
-        self.write(ST77XX_RAMWR)
+        xstart = self.xstart
+        ystart = self.ystart
+        struct.pack_into(_ENCODE_WINDOW, self.winbuf, 0, x0+xstart, x1+xstart, y0+ystart, y1+ystart)
+        dc = self.dc
+        spi = self.spi
+        dc.off()
+        spi.write(ST77XX_CASET)
+        dc.on()
+        spi.write(self.winbuf_cols)
+        dc.off()
+        spi.write(ST77XX_RASET)
+        dc.on()
+        spi.write(self.winbuf_rows)
+        dc.off()
+        spi.write(ST77XX_RAMWR)
 
     # Drawing raw pixels is a fundamental operation so we go low
     # level avoiding function calls. This and other optimizations
     # made drawing 10k pixels with an ESP2866 from 420ms to 100ms.
     def pixel(self,x,y,color):
         if x < 0 or x >= self.width or y < 0 or y >= self.height: return
+        posbuf = self.posbuf
+        spi = self.spi
         self.dc.off()
-        self.spi.write(ST77XX_CASET)
+        spi.write(ST77XX_CASET)
         self.dc.on()
-        self.spi.write(self._encode_pos(x+self.xstart, x+self.xstart))
+        x += self.xstart
+        struct.pack_into(_ENCODE_POS, posbuf, 0, x, x)
+        spi.write(posbuf)
 
         self.dc.off()
-        self.spi.write(ST77XX_RASET)
+        spi.write(ST77XX_RASET)
         self.dc.on()
-        self.spi.write(self._encode_pos(y+self.ystart*2, y+self.ystart*2))
+        y += self.ystart
+        struct.pack_into(_ENCODE_POS, posbuf, 0, y, y)
+        spi.write(posbuf)
 
         self.dc.off()
-        self.spi.write(ST77XX_RAMWR)
+        spi.write(ST77XX_RAMWR)
         self.dc.on()
-        self.spi.write(color)
+        spi.write(color)
+
+    # Return a memoryview of 'npixels' pixels of the specified color,
+    # taken from our preallocated scanline buffer.
+    def get_scanline(self,color,npixels):
+        if self.scanline_color != color:
+            self.scanline[:] = color*(len(self.scanline)//2)
+            self.scanline_color = bytes(color)
+        return self.scanline_mv[:npixels*2]
 
     # Just fill the whole display memory with the specified color.
     # We use a buffer of screen-width pixels. Even in the worst case
@@ -218,7 +276,7 @@ class ST7789_base:
     # per loop dramatically improves performances.
     def fill(self,color):
         self.set_window(0, 0, self.width-1, self.height-1)
-        buf = color*self.width
+        buf = self.get_scanline(color,self.width)
         for i in range(self.height): self.write(None, buf)
 
     # Draw a full or empty rectangle.
@@ -226,13 +284,14 @@ class ST7789_base:
     # w and h are width/height in pixels.
     def rect(self,x,y,w,h,color,fill=False):
         if fill:
-            self.set_window(x,y,x+w-1,y+1-w)
-            if w*h > 256:
-                buf = color*w
+            self.set_window(x,y,x+w-1,y+h-1)
+            if w*h > len(self.scanline)//2:
+                buf = self.get_scanline(color,w)
                 for i in range(h): self.write(None, buf)
             else:
-                buf = color*(w*h)
-                self.write(None, buf)
+                # Small rectangle: it fits in our scanline buffer, so
+                # we can send it with a single write.
+                self.write(None, self.get_scanline(color,w*h))
         else:
             self.hline(x,x+w-1,y,color)
             self.hline(x,x+w-1,y+h-1,color)
@@ -244,14 +303,16 @@ class ST7789_base:
     def hline(self,x0,x1,y,color):
         if y < 0 or y >= self.height: return
         x0,x1 = max(min(x0,x1),0),min(max(x0,x1),self.width-1)
+        if x0 > x1: return # Totally out of display area
         self.set_window(x0, y, x1, y)
-        self.write(None, color*(x1-x0+1))
+        self.write(None, self.get_scanline(color,x1-x0+1))
 
     # Same as hline() but for vertical lines.
     def vline(self,y0,y1,x,color):
         y0,y1 = max(min(y0,y1),0),min(max(y0,y1),self.height-1)
+        if y0 > y1: return # Totally out of display area
         self.set_window(x, y0, x, y1)
-        self.write(None, color*(y1-y0+1))
+        self.write(None, self.get_scanline(color,y1-y0+1))
 
     # Draw a single character 'char' using the font in the MicroPython
     # framebuffer implementation. It is possible to specify the background and
@@ -274,27 +335,64 @@ class ST7789_base:
             # Partial update.
             width = self.width-x # Visible width pixels
             self.set_window(x, y, x+width-1, y+7)
-            copy = bytearray(width*8*2)
-            for dy in range(8):
-                src_idx = (dy*8)*2
-                dst_idx = (dy*width)*2
-                copy[dst_idx:dst_idx+width*2] = self.charfb_data[src_idx:src_idx+width*2]
-            self.write(None,copy)
+            self.clip_char_rows(self.charfb_data,width)
+            self.write(None,memoryview(self.charfb_data)[:width*8*2])
         else:
             self.set_window(x, y, x+7, y+7)
             self.write(None,self.charfb_data)
 
-    # Write text. Like 'char' but for full strings.
+    # Compact the rows of the 8x8 char framebuffer in place, retaining
+    # just the first 'width' pixels of each row, so that the clipped
+    # char can be sent as it is. Since the destination is never after
+    # the source, copying forward is safe.
+    @micropython.viper
+    def clip_char_rows(self, buf: ptr16, width: int):
+        for dy in range(1,8):
+            src = dy*8
+            dst = dy*width
+            for dx in range(width):
+                buf[dst+dx] = buf[src+dx]
+
+    # Draw an image already in the display pixel format (RGB565, two
+    # bytes per pixel, most significant byte first: the same as the
+    # colors returned by color()), streaming it directly to the display
+    # memory. 'buf' must contain w*h pixels, row after row. The image
+    # must be fully inside the display area.
+    def draw_rgb565(self,x,y,w,h,buf):
+        self.set_window(x, y, x+w-1, y+h-1)
+        self.write(None, buf)
+
+    # Write text. Like 'char' but for full strings. The string is
+    # rendered into a framebuffer exactly as wide as the visible part
+    # of the text, so that it can be transferred with a single write.
     def text(self,x,y,txt,fgcolor,bgcolor):
-        for i in range(len(txt)):
-            self.char(x+i*8,y,txt[i],fgcolor,bgcolor)
+        txtwidth = len(txt)*8
+        if x >= self.width or y >= self.height or x+txtwidth <= 0:
+            return # Totally out of display area
+        # Visible columns: text may start before the left edge, or
+        # end after the right edge of the display.
+        x0 = max(x,0)
+        width = min(x+txtwidth,self.width)-x0
+        if self.strfb_data == None:
+            self.strfb_data = bytearray(self.width*8*2)
+        fb = framebuf.FrameBuffer(self.strfb_data,width,8,framebuf.RGB565)
+        fb.fill(bgcolor[1]<<8|bgcolor[0])
+        # Left clipped text is rendered at a negative offset.
+        fb.text(txt,x-x0,0,fgcolor[1]<<8|fgcolor[0])
+        self.set_window(x0, y, x0+width-1, y+7)
+        self.write(None,memoryview(self.strfb_data)[:width*8*2])
 
     # Turn on framebuffer. You can write to it directly addressing
     # the fb instance like in:
     #
     # display.fb.fill(display.fb_color(100,50,50))
     # display.show()
-    def enable_framebuffer(self,mono=False):
+    #
+    # When full_frame is True, in mono mode we also allocate a full
+    # RGB565 frame (115 KB for a 240x240 display), so that show()
+    # converts and transfers the image with a single SPI write.
+    # Otherwise the image is converted and sent a row at a time.
+    def enable_framebuffer(self,mono=False,full_frame=False):
         if mono == False:
             self.fbformat = framebuf.RGB565
             self.rawbuffer = bytearray(self.width*self.height*2)
@@ -303,6 +401,18 @@ class ST7789_base:
             self.fbformat = framebuf.MONO_HMSB
             self.rawbuffer = bytearray((self.width*self.height+7)//8)
             self.show = self.show_mono
+            # If the full frame allocation fails we just fall back
+            # to converting and transferring a row at a time.
+            self.rgbframe = None
+            if full_frame:
+                try:
+                    self.rgbframe = bytearray(self.width*self.height*2)
+                except MemoryError:
+                    pass
+            # Copy of the framebuffer as it was at the last show(), in
+            # order to only transfer the rows that changed. It starts
+            # all zero, that is black, like the display after init().
+            self.prevbuffer = bytearray(len(self.rawbuffer))
 
         self.fb = framebuf.FrameBuffer(self.rawbuffer,
             self.width,self.height,self.fbformat)
@@ -322,23 +432,94 @@ class ST7789_base:
     # of 20x or alike. It converts rows of 1 bit pixels into a rows
     # of RGB565 pixels, to transfer our mono framebuffer in the display
     # memory. On a Raspberry Pico this takes about ~60ms.
+    #
+    # If the full RGB565 frame was allocated, the whole image is
+    # converted into it, and the caller will send it with a single
+    # SPI write. Otherwise a single row buffer is used and each row
+    # is written here, as soon as it is converted.
+    #
+    # When the width is a multiple of 8, rows start at byte boundaries
+    # and we can load each framebuffer byte once and expand its 8 bits
+    # in an unrolled way, instead of computing byte offset and bit
+    # position for every pixel, writing two pixels at a time.
     @micropython.viper
     def fast_mono_to_rgb(self, fb8: ptr8, width: int, height: int):
-        # Just allocate one row worth of buffer.
-        row = bytearray(int(self.width)*2)
-        dst = ptr16(row)
-        bit = int(0)
+        if self.rgbframe:
+            buf = self.rgbframe
+            rowstep = width # Each row goes after the previous one.
+        else:
+            # Just allocate one row worth of buffer.
+            buf = bytearray(int(self.width)*2)
+            rowstep = 0 # Each row overwrites the previous one.
+        dst = ptr16(buf)
+        base = 0
+
+        if width & 7:
+            bit = int(0)
+            for y in range(height):
+                for x in range(width):
+                    byte = bit//8
+                    color = 0xffff * ((fb8[byte] >> (bit&7)) & 1)
+                    dst[base+x] = color
+                    bit += 1
+                if rowstep == 0: self.write(None, buf)
+                base += rowstep
+        else:
+            # Here we write two pixels with each 32 bit store. Rows
+            # start at even pixel offsets so stores are aligned. The
+            # MCUs we run on are little endian, so the first pixel goes
+            # in the low 16 bits.
+            dst32 = ptr32(buf)
+            bytes_per_row = width >> 3
+            byte = int(0)
+            for y in range(height):
+                x = base >> 1
+                for i in range(bytes_per_row):
+                    b = int(fb8[byte])
+                    byte += 1
+                    dst32[x] = (0xffff * (b & 1)) | ((0xffff * ((b >> 1) & 1)) << 16)
+                    dst32[x+1] = (0xffff * ((b >> 2) & 1)) | ((0xffff * ((b >> 3) & 1)) << 16)
+                    dst32[x+2] = (0xffff * ((b >> 4) & 1)) | ((0xffff * ((b >> 5) & 1)) << 16)
+                    dst32[x+3] = (0xffff * ((b >> 6) & 1)) | ((0xffff * ((b >> 7) & 1)) << 16)
+                    x += 4
+                if rowstep == 0: self.write(None, buf)
+                base += rowstep
+
+    # Compare the framebuffer 'cur' with the copy of the last transferred
+    # one 'prev', updating 'prev' as we scan it. Return the first and
+    # last changed rows as first<<16|last, or -1 if nothing changed.
+    @micropython.viper
+    def update_dirty_rows(self, cur: ptr8, prev: ptr8, bytes_per_row: int, height: int) -> int:
+        first = -1
+        last = -1
+        i = 0
         for y in range(height):
-            for x in range(width):
-                byte = bit//8
-                color = 0xffff * ((fb8[byte] >> (bit&7)) & 1)
-                dst[x] = color
-                bit += 1
-            # Each row is written in a single SPI call.
-            self.write(None, row)
+            for x in range(bytes_per_row):
+                if cur[i] != prev[i]:
+                    prev[i] = cur[i]
+                    if first == -1: first = y
+                    last = y
+                i += 1
+        if first == -1: return -1
+        return (first << 16) | last
 
     # Transfer the framebuffer image into the display. 1 bit mode, so
     # this requires a conversion while transferring data.
+    #
+    # Only the range of rows that changed since the last call is
+    # converted and transferred. This requires rows to start at byte
+    # boundaries, so for widths that are not multiple of 8 the whole
+    # image is always transferred.
     def show_mono(self):
-        self.set_window(0,0,self.width-1,self.height-1)
-        self.fast_mono_to_rgb(self.rawbuffer,self.width,self.height)
+        width = self.width
+        if width & 7:
+            y0, y1 = 0, self.height-1
+        else:
+            dirty = self.update_dirty_rows(self.rawbuffer,self.prevbuffer,width>>3,self.height)
+            if dirty == -1: return # Nothing changed.
+            y0, y1 = dirty >> 16, dirty & 0xffff
+        rows = y1-y0+1
+        self.set_window(0,y0,width-1,y1)
+        self.fast_mono_to_rgb(memoryview(self.rawbuffer)[(y0*width)>>3:],width,rows)
+        if self.rgbframe:
+            self.write(None, memoryview(self.rgbframe)[:width*rows*2])
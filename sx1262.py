@@ -8,9 +8,9 @@
 # TODO:
 # - Improve modem_is_receiving_packet() if possible at all with the SX1262.
 
-from machine import Pin, SoftSPI
+from machine import Pin, SPI, SoftSPI
 from micropython import const
-import time, struct, urandom
+import micropython, time, struct, urandom
 
 # SX1262 constants
 
@@ -22,6 +22,25 @@ RegLoRaSyncWordMSB = const(0x0740)
 RegLoRaSyncWordLSB = const(0x0741)
 RegTxClampConfig = const(0x08d8)
 
+# Pre-encoded ReadRegister/WriteRegister arguments (address + data) for
+# the fixed register operations performed by begin() and configure().
+RxGainBoostedArg = bytes([RegRxGain >> 8, RegRxGain & 0xff, RegRxGain_Boosted])
+SyncWordArg = bytes([RegLoRaSyncWordMSB >> 8, RegLoRaSyncWordMSB & 0xff, 0x14, 0x24])
+TxClampReadArg = bytes([RegTxClampConfig >> 8, RegTxClampConfig & 0xff, 0, 0])
+
+# Pre-encoded arguments of commands that always use the same values.
+# TCXO config: 1.7v, 5000us delay, that is 320 (0x000140) 15.625us steps.
+TcxoConfigArg = bytes([1, 0x00, 0x01, 0x40])
+# PA config: duty cycle 4, max output +22 dBm, SX1262 PA (1 would be
+# SX1261), last byte always 1 as for datasheet.
+PaConfigArg = bytes([4, 7, 0, 1])
+DioIrqAllArg = b'\xff'*8 # All IRQs enabled on all the DIOs.
+Zeros2Arg = bytes(2)
+Zeros3Arg = bytes(3)
+Zeros4Arg = bytes(4)
+FF2Arg = b'\xff\xff'
+FF3Arg = b'\xff\xff\xff'
+
 # Dio0 mapping
 IRQSourceNone = const(0)
 IRQSourceTxDone = const(1 << 0)
@@ -88,8 +107,30 @@ class SX1262:
         self.mosi_pin = Pin(pinset['mosi'])
         self.miso_pin = Pin(pinset['miso'])
         self.dio_pin = Pin(pinset['dio'], Pin.IN)
-        self.spi = SoftSPI(baudrate=10000000, polarity=0, phase=0, sck=self.clock_pin, mosi=self.mosi_pin, miso=self.miso_pin)
+        # Use the hardware SPI peripheral if the pinset selects one
+        # with 'spi_channel': it is much faster and does not use the CPU
+        # to toggle the pins. Otherwise fall back to software SPI, that
+        # works with any pins and does not conflict with other devices
+        # (like displays) already using the hardware SPI.
+        if 'spi_channel' in pinset:
+            self.spi = SPI(pinset['spi_channel'], baudrate=10000000, polarity=0, phase=0, sck=self.clock_pin, mosi=self.mosi_pin, miso=self.miso_pin)
+        else:
+            self.spi = SoftSPI(baudrate=10000000, polarity=0, phase=0, sck=self.clock_pin, mosi=self.mosi_pin, miso=self.miso_pin)
         self.bw = 0 # Currently set bandwidth. Saved to compute freq error.
+        # Preallocated (payload,reply) buffers by size, see command().
+        # Commands issued while handling an IRQ use their own set of
+        # buffers: process_irq() is called by the scheduler, and may run
+        # while a command is being composed in the main-line buffers.
+        self.cmdbufs = {}
+        self.irq_cmdbufs = {}
+        self.in_irq = False # True while process_irq() is running.
+        self.freq_arg = None # (freq,encoded_arg) cache for set_frequency().
+        self.ppbuf = bytearray(6) # Packet params, see set_packet_params().
+        self.txbuf = bytearray(2+255) # opcode + offset + max packet.
+        self.txbuf_mv = memoryview(self.txbuf)
+        # Bound method reference for txrxdone(): creating it inside the
+        # hard IRQ handler would allocate memory, that is not allowed.
+        self.process_irq_ref = self.process_irq
          
     def reset(self):
         self.reset_pin.off()
@@ -100,7 +141,7 @@ class SX1262:
         self.tx_in_progress = False
 
     def standby(self):
-        self.command(SetStandByCmd,0) # argument 0 menas STDBY_RC mode.
+        self.command(SetStandByCmd,0,reply=False) # argument 0 menas STDBY_RC mode.
 
     # Note: the CS pin logic is inverted. It requires to be set to low
     # when the chip is NOT selected for data transfer.
@@ -112,43 +153,77 @@ class SX1262:
 
     # Send a read or write command, and return the reply we
     # got back. 'data' can be both an array of a single integer.
-    def command(self, opcode, data=None): 
-        if data != None:
-            if isinstance(data,int): data = [data]
-            payload = bytearray(1+len(data)) # opcode + payload
-            payload[0] = opcode
-            payload[1:] = bytes(data)
+    #
+    # If 'reply' is False, the caller does not need the reply: the
+    # payload is just written, without clocking in the reply bytes,
+    # and None is returned.
+    #
+    # To avoid allocating memory for every command (the function is
+    # also called when processing IRQs) the payload and reply buffers
+    # of small commands are allocated once per size and reused. This
+    # means that the returned reply is only valid up to the next call
+    # to command(), so callers must consume or copy it before that.
+    def command(self, opcode, data=None, reply=True): 
+        if data == None:
+            size = 1
+        elif isinstance(data,int):
+            size = 2
         else:
-            payload = bytearray([opcode])
-        reply = bytearray(len(payload))
+            if isinstance(data,list): data = bytes(data)
+            size = 1+len(data) # opcode + payload
+
+        cache = self.irq_cmdbufs if self.in_irq else self.cmdbufs
+        bufs = cache.get(size)
+        if bufs == None:
+            bufs = (bytearray(size),bytearray(size))
+            # Cache only small buffers: large ones are used just
+            # to transfer packets from/to the chip FIFO.
+            if size <= 16: cache[size] = bufs
+        payload, replybuf = bufs
+        payload[0] = opcode
+        if size == 2 and isinstance(data,int):
+            payload[1] = data
+        elif size > 1:
+            payload[1:] = data
+
+        if not reply:
+            self.transfer(payload)
+            return None
+        self.transfer(payload,replybuf)
+
+        # Enable this for debugging.
+        if False: print(f"Reply for {hex(opcode)} is {repr(replybuf)}")
+
+        return replybuf
 
+    # Send the raw command 'payload' (opcode included) to the chip,
+    # waiting for it to be ready first. If 'reply' is given, the bytes
+    # the chip sends back are stored there.
+    def transfer(self, payload, reply=None):
         # Wait for the chip to return available.
         while self.busy_pin.value():
             time.sleep_us(1)
 
         self.select_chip()
-        self.spi.write_readinto(payload,reply)
+        if reply != None:
+            self.spi.write_readinto(payload,reply)
+        else:
+            self.spi.write(payload)
         self.deselect_chip()
 
-        # Enable this for debugging.
-        if False: print(f"Reply for {hex(opcode)} is {repr(reply)}")
-
-        return reply
-
     def readreg(self, addr, readlen=1):
         payload = bytearray(2+1+readlen) # address + nop + nop*bytes_to_read
-        payload[0] = (addr&0xff00)>>8
-        payload[1] = addr&0xff
+        struct.pack_into(">H",payload,0,addr)
         reply = self.command(ReadRegisterCmd,payload)
         return reply[4:]
 
+    # Write one or more registers. If 'data' is a bytes-like object
+    # with multiple bytes, they are written to consecutive registers
+    # starting at 'addr', in a single transaction.
     def writereg(self, addr, data):
         if isinstance(data,int): data = bytes([data])
-        payload = bytearray(2+len(data)) # address + bytes_to_write
-        payload[0] = (addr&0xff00)>>8
-        payload[1] = addr&0xff
-        payload[2:] = data
-        self.command(WriteRegisterCmd,payload)
+        payload = struct.pack(">H",addr)+data # address + bytes_to_write
+        self.command(WriteRegisterCmd,payload,reply=False)
 
     def readbuf(self, off, numbytes):
         payload = bytearray(2+numbytes)
@@ -156,40 +231,42 @@ class SX1262:
         data = self.command(ReadBufferCmd,payload)
         return data[3:]
 
+    # Write 'data' into the chip FIFO at offset 'off'. This is called
+    # for every packet we send, so the whole command is composed in a
+    # buffer preallocated for the max packet size.
     def writebuf(self, off, data):
-        payload = bytearray(1+len(data))
-        payload[0] = off
-        payload[1:] = data
-        self.command(WriteBufferCmd,payload)
-
-    def set_frequency(self, mhz):
-        # The final frequency is (rf_freq * xtal freq) / 2^25.
-        oscfreq = 32000000 # Oscillator frequency for registers calculation
-        rf_freq = int(mhz * (2**25) / oscfreq)
-        arg = [(rf_freq & 0xff000000) >> 24,
-               (rf_freq & 0xff0000) >> 16,
-               (rf_freq & 0xff00) >> 8,
-               (rf_freq & 0xff)]
-        self.command(SetRfFrequencyCmd, arg)
-
+        datalen = len(data)
+        self.txbuf[0] = WriteBufferCmd
+        self.txbuf[1] = off
+        self.txbuf[2:2+datalen] = data
+        self.transfer(self.txbuf_mv[:2+datalen])
+
+    # Set the frequency, in Hz. The command argument for the last
+    # frequency set is cached, since normally it never changes.
+    def set_frequency(self, freq):
+        if self.freq_arg == None or self.freq_arg[0] != freq:
+            # The final frequency is (rf_freq * xtal freq) / 2^25.
+            # With the 32Mhz oscillator, that's rf_freq * 2^25 / 32000000,
+            # that is rf_freq * 2^14 / 15625, so we can use integer
+            # math only.
+            rf_freq = (int(freq) << 14) // 15625
+            self.freq_arg = (freq,struct.pack(">I",rf_freq))
+        self.command(SetRfFrequencyCmd, self.freq_arg[1],reply=False)
+
+    # Note that this is called by send() for every packet, to set the
+    # payload length, so we encode the params in a preallocated buffer.
     def set_packet_params(self, preamble_len = 12, header_type = PacketHeaderTypeExplicit, payload_len = 255, crc = PacketCRCOn, iq_setup = PacketStandardIQ):
-        pp = bytearray(6)
-        pp[0] = preamble_len >> 8
-        pp[1] = preamble_len & 0xff
-        pp[2] = header_type
-        pp[3] = payload_len
-        pp[4] = crc
-        pp[5] = iq_setup
-        self.command(SetPacketParamsCmd,pp)
+        struct.pack_into(">HBBBB",self.ppbuf,0,preamble_len,header_type,payload_len,crc,iq_setup)
+        self.command(SetPacketParamsCmd,self.ppbuf,reply=False)
 
     def begin(self):
         self.reset()
         self.deselect_chip()
         self.standby()              # SX126x gets configured in standby.
-        self.command(SetPacketTypeCmd,0x01) # Put the chip in LoRa mode.
+        self.command(SetPacketTypeCmd,0x01,reply=False) # Put the chip in LoRa mode.
 
         # Apply fix for PA clamping as specified in datasheet.
-        curval = self.readreg(RegTxClampConfig)[0]
+        curval = self.command(ReadRegisterCmd,TxClampReadArg)[4]
         curval |= 0x1E
         self.writereg(RegTxClampConfig,curval)
 
@@ -216,13 +293,10 @@ class SX1262:
         # during configuration.
         self.standby()
 
-        # Set LoRa parameters.
-        lp = bytearray(4)
-        lp[0] = spreading
-        lp[1] = Bw[bandwidth]
-        lp[2] = CodingRate[rate]
-        lp[3] = 1 # Enable low data rate optimization
-        self.command(SetModulationParamsCmd,lp)
+        # Set LoRa parameters. The last byte set to 1 enables the low
+        # data rate optimization.
+        lp = struct.pack("BBBB",spreading,Bw[bandwidth],CodingRate[rate],1)
+        self.command(SetModulationParamsCmd,lp,reply=False)
 
         # Set packet params.
         self.set_packet_params()
@@ -231,39 +305,26 @@ class SX1262:
         self.set_frequency(freq)
 
         # Use maximum sensibility
-        self.writereg(RegRxGain,0x96)
+        self.command(WriteRegisterCmd,RxGainBoostedArg,reply=False)
 
         # Set TCXO voltage to 1.7 with 5000us delay.
-        tcxo_delay = int(5000.0 / 15.625)
-        tcxo_config = bytearray(4)
-        tcxo_config[0] = 1 # 1.7v
-        tcxo_config[1] = (tcxo_delay >> 16) & 0xff
-        tcxo_config[2] = (tcxo_delay >> 8) & 0xff
-        tcxo_config[3] = (tcxo_delay >> 0) & 0xff
-        self.command(SetDIO3AsTCXOCtrlCmd,tcxo_config)
+        self.command(SetDIO3AsTCXOCtrlCmd,TcxoConfigArg,reply=False)
 
         # Set DIO2 as RF switch like in Semtech examples.
-        self.command(SetDIO2AsRfSwitchCtrlCmd,1)
+        self.command(SetDIO2AsRfSwitchCtrlCmd,1,reply=False)
 
         # Set the power amplifier configuration.
-        paconfig = bytearray(4)
-        paconfig[0] = 4 # Duty Cycle of 4
-        paconfig[1] = 7 # Max output +22 dBm
-        paconfig[2] = 0 # Select PA for SX1262 (1 would be SX1261)
-        paconfig[3] = 1 # Always set to 1 as for datasheet
-        self.command(SetPaConfigCmd,paconfig)
+        self.command(SetPaConfigCmd,PaConfigArg,reply=False)
 
         # Set TX power and ramping. We always use high power mode.
+        # The power is a signed byte, the ramping time 4 means 200us.
         txpower = min(max(-9,txpower),22)
-        txparams = bytearray(2)
-        txparams[0] = (0xF7 + (txpower+9)) % 256
-        txparams[1] = 4 # 200us ramping time
-        self.command(SetTxParamsCmd,txparams)
+        self.command(SetTxParamsCmd,struct.pack("bB",txpower,4),reply=False)
 
         # We either receive or send, so let's use all the 256 bytes
         # of FIFO available by setting both recv and send FIFO address
         # to the base.
-        self.command(SetBufferBaseAddressCmd,[0,0])
+        self.command(SetBufferBaseAddressCmd,Zeros2Arg,reply=False)
        
         # Setup the IRQ handler to receive the packet tx/rx and
         # other events. Note that the chip will put the packet
@@ -271,15 +332,16 @@ class SX1262:
         # We will enable all DIOs for all the interrputs. In
         # practice most of the times only one chip DIO is connected
         # to the MCU.
-        self.dio_pin.irq(handler=self.txrxdone, trigger=Pin.IRQ_RISING)
-        self.command(SetDioIrqParamsCmd,[0xff,0xff,0xff,0xff,0xff,0xff,0xff,0xff])
+        self.dio_pin.irq(handler=self.txrxdone, trigger=Pin.IRQ_RISING, hard=True)
+        self.command(SetDioIrqParamsCmd,DioIrqAllArg,reply=False)
         self.clear_irq()
 
         # Set sync word to 0x12 (private network).
         # Note that "12" is in the most significant hex digits of
-        # the two registers: [1]4 and [2]4.
-        self.writereg(RegLoRaSyncWordMSB,0x14)
-        self.writereg(RegLoRaSyncWordLSB,0x24)
+        # the two registers: [1]4 and [2]4. The registers are adjacent
+        # and the chip auto-increments the address, so a single write
+        # sets both.
+        self.command(WriteRegisterCmd,SyncWordArg,reply=False)
 
         # Calibrate for the specific selected frequency
         if 430 <= freq <= 440: f1,f2 = 0x6b,0x6f
@@ -290,7 +352,7 @@ class SX1262:
         else: f1,f2 = None,None
 
         if f1 and f2:
-            self.command(CalibrateImageCmd,[f1,f2])
+            self.command(CalibrateImageCmd,[f1,f2],reply=False)
 
     # This is just for debugging. We can understand if a given command
     # caused a failure while debugging the driver since the command status
@@ -307,19 +369,35 @@ class SX1262:
     # receives anything, so it may be a better approach to
     # set a timeout and re-enter receive from time to time?
     def receive(self):
-        self.command(SetRxCmd,[0xff,0xff,0xff])
+        self.command(SetRxCmd,FF3Arg,reply=False)
         self.receiving = True
     
     def get_irq(self):
-        reply = self.command(GetIrqStatusCmd,[0,0,0])
+        reply = self.command(GetIrqStatusCmd,Zeros3Arg)
         return (reply[2]<<8) | reply[3]
 
     def clear_irq(self):
-        reply = self.command(ClearIrqStatusCmd,[0xff,0xff])
+        self.command(ClearIrqStatusCmd,FF2Arg,reply=False)
 
-    # This is our IRQ handler. By default we don't mask any interrupt
-    # so the function may be called for more events we actually handle.
+    # This is our IRQ handler. It runs in interrupt context, where we
+    # can't allocate memory and should return ASAP, so the actual work
+    # (SPI transfers, callbacks) is scheduled to run in process_irq().
     def txrxdone(self, pin):
+        micropython.schedule(self.process_irq_ref, pin)
+
+    # Called via micropython.schedule() by the IRQ handler. Scheduled
+    # functions don't nest, so while in_irq is set only the code called
+    # from here uses the IRQ command buffers.
+    def process_irq(self, pin):
+        self.in_irq = True
+        try:
+            self.process_events()
+        finally:
+            self.in_irq = False
+
+    # Handle the chip events. By default we don't mask any interrupt so
+    # the function may be called for more events we actually handle.
+    def process_events(self):
         event = self.get_irq()
         self.clear_irq()
 
@@ -327,13 +405,12 @@ class SX1262:
             # Packet received. The channel is no longer busy.
             self.packet_on_air = False
 
-            # Obtain packet information.
-            bs = self.command(GetRxBufferStatusCmd,[0]*3)
-            ps = self.command(GetPacketStatusCmd,[0]*4)
-
-            # Extract packet information.
+            # Obtain and extract packet information. Note that the
+            # reply of command() is only valid up to the next call.
+            bs = self.command(GetRxBufferStatusCmd,Zeros3Arg)
             packet_len = bs[2]
             packet_start = bs[3]
+            ps = self.command(GetPacketStatusCmd,Zeros4Arg)
             rssi = -ps[2]/2 # Average RSSI in dB.
             snr = ps[3]-256 if ps[3] > 128 else ps[3] # Convert to unsigned
             snr /= 4 # The reported value is upscaled 4 times.
@@ -369,7 +446,7 @@ class SX1262:
             print("SX1262: not handled event IRQ flags "+bin(event))
 
     def get_instantaneous_rss(self):
-        data = self.command(0x15,[0,0])
+        data = self.command(0x15,Zeros2Arg)
         return -data[2]/2
 
     # This modem is used for listen-before-talk and returns true if
@@ -398,7 +475,7 @@ class SX1262:
         self.tx_in_progress = True
         self.set_packet_params(payload_len = len(data))
         self.writebuf(0x00,data)
-        self.command(SetTxCmd,[0,0,0]) # Enter TX mode without timeout.
+        self.command(SetTxCmd,Zeros3Arg,reply=False) # Enter TX mode without timeout.
 
 # Example usage.
 if  __name__ == "__main__":
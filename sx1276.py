@@ -5,8 +5,9 @@
 # This code is released under the BSD 2 clause license.
 # See the LICENSE file for more information
 
-from machine import Pin, SoftSPI
+from machine import Pin, SPI, SoftSPI
 from micropython import const
+import micropython
 import time, struct, urandom
 
 # SX1276 constants
@@ -43,6 +44,11 @@ RegDioMapping1 = const(0x40)
 RegVersion = const(0x42)
 RegPaDac = const(0x4d)
 
+# Oscillator frequency, and log2 of the number of frequency steps in it,
+# for the frequency registers calculation.
+OscFreq = const(32000000)
+FreqStepShift = const(19)
+
 # Working modes
 ModeSleep = const(0x00)
 ModeStandby = const(0x01)
@@ -71,11 +77,53 @@ ModemStatusRXOngoing = const(1<<2)
 ModemStatusHeaderInfoValid = const(1<<3)
 ModemStatusModemClear = const(1<<4)
 
+# Bandwidth and coding rate values for RegModemConfig1.
+Bandwidths = {   7800: 0b0000,
+                10400: 0b0001,
+                15600: 0b0010,
+                20800: 0b0011,
+                31250: 0b0100,
+                41700: 0b0101,
+                62500: 0b0110,
+               125000: 0b0111,
+               250000: 0b1000,
+               500000: 0b1001}
+CodingRates = {  5:0b001,
+                 6:0b010,
+                 7:0b011,
+                 8:0b100}
+
+# Convert the raw packet SNR and RSSI registers into the packet RSSI,
+# returned in hundredths of dbm since viper can't use floats.
+#
+# We use the formula found in the chip datasheet: the SNR is taken into
+# account only when the message we received has a power under the noise
+# level. Odd but possible with LoRa modulation. The SNR register is
+# a two's complement value, in steps of 0.25 dB (section 3.5.5 of the
+# chip spec), so SNR*100 is snr*25.
+#
+# Note: this forumla is correct for HF (high frequency) port,
+# but otherwise the constant -157 should be replaced with -164.
+#
+# The function is branchless: the SNR byte is sign extended with
+# a xor/sub, and its sign, as an all ones / all zeros mask, selects
+# one of the two formulas. 16/15*100 is approximated as 27307/256,
+# so that no division is needed: the error is under 0.001 dbm for
+# all the possible register values.
+@micropython.viper
+def compute_rssi(snr:int, rssi:int) -> int:
+    snr = (snr ^ 0x80) - 0x80   # Sign extend the 8 bit value.
+    neg = snr >> 8              # -1 if SNR is negative, otherwise 0.
+    pos_rssi = (rssi*27307) >> 8
+    neg_rssi = rssi*100 + snr*25
+    return -15700 + ((pos_rssi & ~neg) | (neg_rssi & neg))
+
 class SX1276:
     def __init__(self, pinset, rx_callback, tx_callback = None):
         self.receiving = False
         self.tx_in_progress = False
         self.msg_sent = 0
+        self.unhandled_irqs = 0 # IRQs with unexpected flags, for debugging.
         self.received_callback = rx_callback
         self.transmitted_callback = tx_callback
         self.reset_pin = Pin(pinset['reset'],Pin.OUT)
@@ -84,8 +132,35 @@ class SX1276:
         self.mosi_pin = Pin(pinset['mosi'])
         self.miso_pin = Pin(pinset['miso'])
         self.dio0_pin = Pin(pinset['dio0'], Pin.IN)
-        self.spi = SoftSPI(baudrate=10000000, polarity=0, phase=0, sck=self.clock_pin, mosi=self.mosi_pin, miso=self.miso_pin)
+        # Use the hardware SPI peripheral if the pinset selects one
+        # with 'spi_channel', otherwise fall back to software SPI, that
+        # works with any pins. See the same code in the SX1262 driver.
+        if 'spi_channel' in pinset:
+            self.spi = SPI(pinset['spi_channel'], baudrate=10000000, polarity=0, phase=0, sck=self.clock_pin, mosi=self.mosi_pin, miso=self.miso_pin)
+        else:
+            self.spi = SoftSPI(baudrate=10000000, polarity=0, phase=0, sck=self.clock_pin, mosi=self.mosi_pin, miso=self.miso_pin)
         self.bw = 0 # Currently set bandwidth. Saved to compute freq error.
+        # Buffer for FIFO transfers: register address + max FIFO size.
+        self.fifobuf = bytearray(1+256)
+        self.fifobuf_mv = memoryview(self.fifobuf)
+        self.rxbuf = bytearray(1+256) # Same as fifobuf, for FIFO reads.
+        self.hdrbuf = bytearray(1) # Register address for burst writes.
+        self.write1_buf = bytearray(2) # Single register writes.
+        self.regsbuf = bytearray(5) # Burst reads of adjacent registers.
+        self.regsbuf_mv = memoryview(self.regsbuf)
+        # Same as above, but used while handling the chip events:
+        # process_irq() is called by the scheduler, and may run while
+        # the main-line code is filling the buffers above.
+        self.irq_write1_buf = bytearray(2)
+        self.irq_regsbuf_mv = memoryview(bytearray(5))
+        self.in_irq = False # True while process_irq() is running.
+        # Buffers for single register reads, that are performed
+        # many times in the IRQ handler: avoid allocating each time.
+        self.read1_tx = bytearray(2)
+        self.read1_rx = bytearray(2)
+        # Bound method reference for txrxdone(): creating it inside the
+        # hard IRQ handler would allocate memory, that is not allowed.
+        self.process_irq_ref = self.process_irq
          
     def reset(self):
         self.reset_pin.off()
@@ -106,61 +181,40 @@ class SX1276:
     def begin(self):
         self.reset()
         self.deselect_chip()
-        self.spi_write(RegOpMode,ModeSleep) # Put in sleep
-        self.spi_write(RegOpMode,ModeSleep | 1<<7) # Enable LoRa radio
+        self.spi_write_byte(RegOpMode,ModeSleep) # Put in sleep
+        self.spi_write_byte(RegOpMode,ModeSleep | 1<<7) # Enable LoRa radio
 
     # Set the radio parameters. Allowed spreadings are from 6 to 12.
-    # Bandwidth and coding rate are listeed below in the dictionaries.
+    # Bandwidth and coding rate are listed in the Bandwidths and
+    # CodingRates dictionaries at the top of the file.
     # TX power is from 2 to 20 dbm.
     def configure(self, freq, bandwidth, rate, spreading, txpower):
-        Bw = {   7800: 0b0000,
-                10400: 0b0001,
-                15600: 0b0010,
-                20800: 0b0011,
-                31250: 0b0100,
-                41700: 0b0101,
-                62500: 0b0110,
-               125000: 0b0111,
-               250000: 0b1000,
-               500000: 0b1001}
-        CodingRate = {  5:0b001,
-                        6:0b010,
-                        7:0b011,
-                        8:0b100}
+        # Note that when writing multiple bytes in the same SPI
+        # transaction, the chip auto-increments the register address,
+        # so we set adjacent registers with a single spi_write() call.
 
-        # Set bandwidth and coding rate. Lower bit is left to 0, so
-        # explicit header is selected.
+        # Set bandwidth and coding rate (RegModemConfig1). Lower bit is
+        # left to 0, so explicit header is selected.
+        # Set spreading, CRC ON, TX mode normal (RegModemConfig2).
         self.bw = bandwidth
-        self.spi_write(RegModemConfig1, Bw[bandwidth] << 4 | CodingRate[rate] << 1)
-
         RxPayloadCrcOn   = 1
-        # Set spreading, CRC ON, TX mode normal
-        self.spi_write(RegModemConfig2, spreading << 4 | RxPayloadCrcOn << 2)
+        self.spi_write(RegModemConfig1, bytes([
+            Bandwidths[bandwidth] << 4 | CodingRates[rate] << 1,
+            spreading << 4 | RxPayloadCrcOn << 2]))
 
         # Enable low data rate optimizer and AGC.
-        self.spi_write(RegModemConfig3, 1 << 3 | 1 << 2)  
+        self.spi_write_byte(RegModemConfig3, 1 << 3 | 1 << 2)  
         
-        # Preamble length
-        self.spi_write(RegPreambleMsb, 0)  # No need to set a huge preamble.
-        self.spi_write(RegPreambleLsb, 12) # LSB set to 12. So preamble len: 12
+        # Preamble length: MSB 0 (no need to set a huge preamble),
+        # LSB set to 12. So preamble len: 12.
+        self.spi_write(RegPreambleMsb, bytes([0, 12]))
         
-        # Set frequency
-        oscfreq = 32000000 # Oscillator frequency for registers calculation
-
-        # The frequency step is: oscillator frequency / 2^19.
-        fstep = oscfreq / (2**19)
-
-        # Compute the frequency we want in terms of steps, then
-        # set the three registers composing the frequency.
-        freq_in_steps = int(freq/fstep)
-        self.spi_write(RegFrfMsb,(freq_in_steps >> 16) & 0xff)
-        self.spi_write(RegFrfMid,(freq_in_steps >> 8) & 0xff)
-        self.spi_write(RegFrfLsb,(freq_in_steps >> 0) & 0xff)
+        self.set_frequency(freq)
 
         # Set TX power. We always use PA_BOOST mode. For powers
         # between 2 and 17 we use normal operations, from 18
         # to 20 we enable the special 20DBM mode.
-        txpower = min(max(2,txpower),20)
+        txpower = 2 if txpower < 2 else 20 if txpower > 20 else txpower
 
         # Enable PA_BOOST.
         boost = 1<<7
@@ -182,27 +236,29 @@ class SX1276:
             outpower = txpower-5
         else:
             outpower = txpower-2
-        self.spi_write(RegPaConfig, boost|maxpower|outpower)
+        self.spi_write_byte(RegPaConfig, boost|maxpower|outpower)
 
         # For high powers, select the special 20dbm mode and disable any
         # overcurrent protection, to make sure the TX circuit can drain
         # as much as needed. Without setting such registers PA_BOOST can
         # deliver 17dbm max.
         if txpower > 17:
-            self.spi_write(RegOcp, (1<<5)|18)   # Max current allowed
-            self.spi_write(RegPaDac, 0x87)      # Select 20dbm mode
+            self.spi_write_byte(RegOcp, (1<<5)|18)   # Max current allowed
+            self.spi_write_byte(RegPaDac, 0x87)      # Select 20dbm mode
 
         # We either receive or send, so let's use all the 256 bytes
         # of FIFO available by setting both recv and send FIFO address
         # to the base.
-        self.spi_write(RegFifoTxBaseAddr, 0)
-        self.spi_write(RegFifoRxBaseAddr, 0)
+        self.spi_write(RegFifoTxBaseAddr, bytes([0, 0])) # Tx and Rx base.
        
         # Setup the IRQ handler to receive the packet tx/rx and
         # other events. Note that the chip will put the packet
         # on the FIFO even on CRC error.
-        self.dio0_pin.irq(handler=self.txrxdone, trigger=Pin.IRQ_RISING)
-        self.spi_write(RegIrqFlagsMask, 0) # Don't mask any IRQ.
+        self.dio0_pin.irq(handler=self.txrxdone, trigger=Pin.IRQ_RISING, hard=True)
+        # Mask all the IRQs we don't handle: a bit set to 1 in the mask
+        # register disables the corresponding flag.
+        self.spi_write_byte(RegIrqFlagsMask,
+            0xff & ~(IRQRxDone|IRQTxDone|IRQPayloadCrcError))
 
         # Set sync word to 0x12 (private network).
         # Line is commented for now since 0x12 is already the default
@@ -214,21 +270,51 @@ class SX1276:
         # We will change the mode later, to do rx or tx. The
         # configure() method should be called after the begin() method,
         # so the chip was in sleep during the configuration.
-        self.spi_write(RegOpMode, ModeStandby)
+        self.spi_write_byte(RegOpMode, ModeStandby)
     
+    # Set the frequency, in Hz. Can be called after configure() to
+    # change just the frequency, without setting all the other
+    # registers again.
+    def set_frequency(self, freq):
+        # The frequency step is: oscillator frequency / 2^19.
+        #
+        # Compute the frequency we want in terms of steps, then
+        # set the three registers composing the frequency. They are
+        # adjacent, so a single burst write is enough. The chip
+        # applies the new frequency when the LSB is written.
+        freq_in_steps = (int(freq) << FreqStepShift) // OscFreq
+        self.spi_write(RegFrfMsb, bytes([
+            (freq_in_steps >> 16) & 0xff,
+            (freq_in_steps >> 8) & 0xff,
+            (freq_in_steps >> 0) & 0xff]))
+
     def spi_write(self, regid, data): 
         # Writes are performed sending as first byte the register
         # we want to address, with the highest bit set.
-        if isinstance(data,int):
-            spi_payload = bytes([regid|0x80,data])
-        elif isinstance(data,str):
-            spi_payload = bytes([regid|0x80]) + bytes(data, 'utf-8')
-        elif isinstance(data,bytes) or isinstance(data,bytearray):
-            spi_payload = bytes([regid|0x80]) + data
+        #
+        # 'data' is either an integer, to write a single register, or
+        # a bytes/bytearray object for burst writes. Strings must be
+        # encoded by the caller.
+        if type(data) is int:
+            self.spi_write_byte(regid,data)
         else:
-            raise Exception("spi_write can only handle integers and strings. We got: ",repr(data))
+            # Don't concatenate the register and the payload: send
+            # them with two writes in the same transaction.
+            self.hdrbuf[0] = regid|0x80
+            self.select_chip()
+            self.spi.write(self.hdrbuf)
+            self.spi.write(data)
+            self.deselect_chip()
+
+    # Write a single register. This is by far the most common write,
+    # so it has its own function, without spi_write() type dispatching,
+    # using a preallocated buffer.
+    def spi_write_byte(self, regid, value):
+        buf = self.irq_write1_buf if self.in_irq else self.write1_buf
+        buf[0] = regid|0x80
+        buf[1] = value
         self.select_chip()
-        self.spi.write(spi_payload)
+        self.spi.write(buf)
         self.deselect_chip()
 
     # SPI read. For simplicity in the API, if the read len is one
@@ -237,51 +323,106 @@ class SX1276:
     # byte, as said).
     def spi_read(self, regid, l=1):
         # Reads are similar to writes but we don't need to set
-        # the highest bit of the byte, so the SPI library will take
-        # care of writing the register.
+        # the highest bit of the byte. The transfer is performed in
+        # the preallocated receive buffer, so the only allocation is
+        # the returned copy.
+        if l == 1: return self.spi_read_byte(regid)
+        mv = memoryview(self.rxbuf)[:l+1]
+        mv[0] = regid
         self.select_chip()
-        if l == 1:
-            rcv = self.spi.read(l+1,regid)[1]
-        else:
-            rcv = self.spi.read(l+1,regid)[1:]
+        self.spi.write_readinto(mv,mv)
         self.deselect_chip()
-        return rcv
-
-    # This is our IRQ handler. By default we don't mask any interrupt
-    # so the function may be called for more events we actually handle.
-    def txrxdone(self, pin): 
-        event = self.spi_read(RegIrqFlags)
-        self.spi_write(RegIrqFlags, 0xff) # Clear flags
+        return bytes(mv[1:])
+
+    # Read a single register using the preallocated buffers, so that
+    # the IRQ handler, that performs many single byte reads, does not
+    # allocate memory.
+    @micropython.native
+    def spi_read_byte(self, regid):
+        self.read1_tx[0] = regid
+        self.select_chip()
+        self.spi.write_readinto(self.read1_tx,self.read1_rx)
+        self.deselect_chip()
+        return self.read1_rx[1]
+
+    # Burst read of 'l' (at most 4) adjacent registers starting at
+    # 'regid'. Like spi_read_fifo(), a memoryview of a preallocated
+    # buffer is returned, valid only until the next call.
+    @micropython.native
+    def spi_read_regs(self, regid, l):
+        mv = (self.irq_regsbuf_mv if self.in_irq else self.regsbuf_mv)[:l+1]
+        mv[0] = regid
+        self.select_chip()
+        self.spi.write_readinto(mv,mv)
+        self.deselect_chip()
+        return mv[1:]
+
+    # Read 'l' bytes from the FIFO into the preallocated receive buffer.
+    # A memoryview of the buffer is returned, so the data is only valid
+    # until the next FIFO read: callers must copy it if they need to
+    # retain it.
+    def spi_read_fifo(self, l):
+        mv = memoryview(self.rxbuf)[:l+1]
+        mv[0] = RegFifo
+        self.select_chip()
+        self.spi.write_readinto(mv,mv)
+        self.deselect_chip()
+        return mv[1:]
+
+    # This is our IRQ handler. It runs in interrupt context, where we
+    # can't allocate memory and should return ASAP, so the actual
+    # work (SPI transfers, callbacks) is scheduled to run in
+    # process_irq().
+    def txrxdone(self, pin):
+        micropython.schedule(self.process_irq_ref, pin)
+
+    # Called via micropython.schedule() by the IRQ handler. Scheduled
+    # functions don't nest, so while in_irq is set only the code called
+    # from here uses the IRQ buffers.
+    def process_irq(self, pin):
+        self.in_irq = True
+        try:
+            self.process_events()
+        finally:
+            self.in_irq = False
+
+    # Handle the chip events. Only the RX done, TX done and CRC error
+    # interrupts are enabled in configure().
+    @micropython.native
+    def process_events(self):
+        # Avoid looking up the method we call many times.
+        write = self.spi_write_byte
+
+        # RegFifoRxCurrentAddr, RegIrqFlagsMask, RegIrqFlags and
+        # RegRxNbBytes are adjacent: read them all in a single burst.
+        # The FIFO address and length are only used on RX, but reading
+        # them is cheaper than another transaction.
+        regs = self.spi_read_regs(RegFifoRxCurrentAddr,4)
+        addr = regs[0]
+        event = regs[2]
+        packet_len = regs[3]
+        write(RegIrqFlags, 0xff) # Clear flags
         if event & IRQRxDone:
             bad_crc = (event & IRQPayloadCrcError) != 0
             # Read data from the FIFO
-            addr = self.spi_read(RegFifoRxCurrentAddr)
-            self.spi_write(RegFifoAddrPtr, addr) # Read starting from addr
-            packet_len = self.spi_read(RegRxNbBytes)
-            packet = self.spi_read(RegFifo, packet_len)
-            snr = self.spi_read(RegPktSnrValue)
-            snr /= 4 # Packet SNR * 0.25, section 3.5.5 of chip spec.
-            rssi = self.spi_read(RegPktRssiValue) 
-
-            # Convert RSSI, also taking into account SNR, but only when the
-            # message we received has a power under the noise level. Odd
-            # but possible with LoRa modulation.
-            #
-            # We use the formula found in the chip datasheet.
-            # Note: this forumla is correct for HF (high frequency) port,
-            # but otherwise the constant -157 should be replaced with
-            # -164.
-            if snr >= 0:
-                rssi = round(-157+16/15*rssi,2)
-            else:
-                rssi = round(-157+rssi+snr,2)
+            write(RegFifoAddrPtr, addr) # Read starting from addr
+            packet = self.spi_read_fifo(packet_len)
+            # RegPktSnrValue and RegPktRssiValue are adjacent as well.
+            regs = self.spi_read_regs(RegPktSnrValue,2)
+            snr = regs[0]
+            rssi = regs[1]
+
+            # Convert RSSI, also taking into account SNR.
+            rssi = compute_rssi(snr,rssi)/100
 
             if bad_crc:
                 print("SX1276: packet with bad CRC received")
 
-            # Call the callback the user registered, if any.
+            # Call the callback the user registered, if any. The
+            # receive buffer is reused by the next packet, and the
+            # callback may retain the packet, so we pass a copy.
             if self.received_callback:
-                self.received_callback(self, packet, rssi, bad_crc)
+                self.received_callback(self, bytes(packet), rssi, bad_crc)
         elif event & IRQTxDone:
             self.msg_sent += 1
             # After sending a message, the chip will return in
@@ -291,7 +432,9 @@ class SX1276:
             if self.receiving: self.receive()
             self.tx_in_progress = False
         else: 
-            print("SX1276: not handled event IRQ flags "+str(event))
+            # Should not happen, since other IRQs are masked. Just
+            # count them.
+            self.unhandled_irqs += 1
 
     def get_modem_stat(self):
         return self.spi_read(RegModemStat)
@@ -301,28 +444,43 @@ class SX1276:
 
     def receive(self):    
         # Raise IRQ when a packet is received.
-        self.spi_write(RegDioMapping1, Dio0RxDone)
+        self.spi_write_byte(RegDioMapping1, Dio0RxDone)
         # Go in continuous receiving mode.
-        self.spi_write(RegOpMode, ModeContRx)
+        self.spi_write_byte(RegOpMode, ModeContRx)
         self.receiving = True
         
+    # Send the packet 'data' (bytes or bytearray, up to 255 bytes).
+    #
+    # Each of the register writes below needs its own SPI transaction,
+    # since the registers are not adjacent, but at least the FIFO is
+    # populated with a single burst composed in a preallocated buffer,
+    # instead of concatenating the register address and the payload.
     def send(self, data): 
         self.tx_in_progress = True
-        self.spi_write(RegDioMapping1, Dio0TxDone)
-        self.spi_write(RegFifoAddrPtr, 0) # Write data starting from FIFO byte 0
-        self.spi_write(RegFifo, data)     # Populate FIFO with message
-        self.spi_write(RegPayloadLength, len(data))  # Store len of message
-        self.spi_write(RegOpMode, ModeTx) # Switch to TX mode
+        self.spi_write_byte(RegDioMapping1, Dio0TxDone)
+        self.spi_write_byte(RegFifoAddrPtr, 0) # Write data starting from FIFO byte 0
+
+        # Populate FIFO with message
+        datalen = len(data)
+        self.fifobuf[0] = RegFifo|0x80
+        self.fifobuf[1:1+datalen] = data
+        self.select_chip()
+        self.spi.write(self.fifobuf_mv[:1+datalen])
+        self.deselect_chip()
+
+        self.spi_write_byte(RegPayloadLength, datalen)  # Store len of message
+        self.spi_write_byte(RegOpMode, ModeTx) # Switch to TX mode
 
     def get_freq_error(self):
         # Read 20 bit two's complement frequency error indicator.
-        fei = (self.spi_read(RegFeiMsb) << 16) | (self.spi_read(RegFeiMsb) << 8) | self.spi_read(RegFeiLsb)
+        # RegFeiMsb, RegFeiMid and RegFeiLsb are adjacent, so we can
+        # read them with a single burst.
+        fei = self.spi_read_regs(RegFeiMsb,3)
+        fei = ((fei[0] & 0x0f) << 16) | (fei[1] << 8) | fei[2]
         # Convert negative values from two's complement.
-        if fei & (1<<19):
-            fei = fei ^ (1<<19) # Clear sign bit
-            fei = fei ^ 0b1111111111111111111 # Invert bits
-            fei = -(fei+1) # Obtain negative value
-        # Convert value in Hertz (section 4.1.5 of datasheet)
-        errhz = fei*0.524288 # Magic constant is 2**24 / 32e6
-        errhz = int(errhz*self.bw/500)
-        return errhz
+        if fei & (1<<19): fei -= 1<<20
+        # Convert value in Hertz (section 4.1.5 of datasheet):
+        # fei * 2**24 / 32e6 * bw / 500, using integer math only. We
+        # want to truncate towards zero like int() did.
+        errhz = abs(fei)*524288*self.bw//500000000
+        return -errhz if fei < 0 else errhz
@@ -4,28 +4,47 @@
 # This code is released under the BSD 2 clause license.
 # See the LICENSE file for more information
 
-import network, socket, ssl, time, uasyncio as asyncio, json
+import network, socket, ssl, time, uasyncio as asyncio, json, urandom
 
 class TelegramBot:
     def __init__(self,token,callback):
         self.token = token
         self.callback = callback
-        self.rbuf = bytearray(4096)
+        self.rbuf = bytearray(4096) # Grows up to rbuf_max if needed.
         self.rbuf_mv = memoryview(self.rbuf)
         self.rbuf_used = 0
+        self.rbuf_max = 16384
+        self.sur_buf = bytearray(len(self.rbuf)) # See decode_surrogate_pairs().
         self.active = True # So we can stop the task with .stop()
         self.debug = False
         self.missed_write = None # Failed write payload. This is useful
                                  # in order to retransfer after reconnection.
 
         # Array of outgoing messages. Each entry is a hash with
-        # chat_id and text fields.
+        # chat_id and text fields. New messages are appended at the
+        # end, and are consumed starting at outgoing_head, so that
+        # taking the oldest message doesn't shift the whole list.
         self.outgoing = []
+        self.outgoing_head = 0 # Index of the oldest message not yet sent.
+        # Set by send() to wake up the main loop. It's a ThreadSafeFlag
+        # and not an Event since send() may be called from callbacks
+        # scheduled with micropython.schedule(), like the LoRa ones.
+        self.outgoing_flag = asyncio.ThreadSafeFlag()
         self.pending = False # Pending HTTP request, waiting for reply.
         self.reconnect = True # We need to reconnect the socket, either for
                               # the first time or after errors.
         self.offset = 0     # Next message ID offset.
+        self.updates_limit = 4 # Max updates per getUpdates. Drops to 1
+                               # if a reply does not fit the read buffer.
+        self.post_prefix = {} # POST headers prefix cache, by command.
+        # getUpdates request, only the offset and the limit change. We
+        # only want to receive messages and channel posts, so
+        # allowed_updates is set to the URL-encoded JSON list
+        # ["message","channel_post"] (the "%" are doubled because of
+        # the formatting).
+        self.get_updates_fmt = "GET /bot"+token+"/getUpdates?offset=%d&timeout=0&allowed_updates=%%5B%%22message%%22%%2C%%22channel_post%%22%%5D&limit=%d HTTP/1.1\r\nHost:api.telegram.org\r\n\r\n"
         self.watchdog_timeout_ms = 60000 # 60 seconds max idle time.
+        self.connect_failures = 0 # Consecutive failed connection attempts.
 
     # Stop the task handling the bot. This should be called before
     # destroying the object, in order to also terminate the task.
@@ -36,6 +55,10 @@ class TelegramBot:
     # Sould be executed asynchronously, like with:
     # asyncio.create_task(bot.run())
     async def run(self):
+        # Avoid looking up the time functions in the module at
+        # every iteration.
+        ticks_ms = time.ticks_ms
+        ticks_diff = time.ticks_diff
         while self.active:
             if self.reconnect:
                 if self.debug: print("[telegram] Reconnecting socket.")
@@ -49,22 +72,38 @@ class TelegramBot:
                     self.ssl = ssl.wrap_socket(self.socket)
                     self.reconnect = False
                     self.pending = False
+                    self.connect_failures = 0
                 except:
+                    # Don't retry in a tight loop if the network is
+                    # down: wait 2, 4, 8, ... up to 30 seconds, plus
+                    # some random jitter, before trying again. The
+                    # exponent is capped too, so that after a long
+                    # outage we don't compute huge powers of two.
                     self.reconnect = True
+                    self.connect_failures += 1
+                    delay = min(30,1 << min(self.connect_failures,5))
+                    await asyncio.sleep(delay+urandom.getrandbits(10)/1024)
+                    continue
 
             self.send_api_requests()
             self.read_api_response()
 
             # Watchdog: if the connection is idle for a too long
             # time, force a reconnection.
-            if self.pending and time.ticks_diff(time.ticks_ms(),self.pending_since) > self.watchdog_timeout_ms:
+            if self.pending and ticks_diff(ticks_ms(),self.pending_since) > self.watchdog_timeout_ms:
                 self.reconnect = True
                 print("[telegram] *** SOCKET WATCHDOG EXPIRED ***")
 
             # If there are outgoing messages pending, wait less
-            # to do I/O again.
-            sleep_time = 0.1 if len(self.outgoing) > 0 else 1.0
-            await asyncio.sleep(sleep_time)
+            # to do I/O again. Otherwise wait up to one second, but
+            # wake up as soon as send() queues a new message.
+            if len(self.outgoing) > self.outgoing_head:
+                await asyncio.sleep(0.1)
+            else:
+                try:
+                    await asyncio.wait_for(self.outgoing_flag.wait(),1)
+                except asyncio.TimeoutError:
+                    pass
 
     # Send HTTP requests to the server. If there are no special requests
     # to handle (like sendMessage) we just ask for updates with getUpdates.
@@ -80,17 +119,26 @@ class TelegramBot:
 
         # Issue sendMessage requests if we have pending
         # messages to deliver.
-        elif len(self.outgoing) > 0:
-            oldest = self.outgoing.pop()
+        elif len(self.outgoing) > self.outgoing_head:
+            oldest = self.outgoing[self.outgoing_head]
+            self.outgoing[self.outgoing_head] = None # Release it.
+            self.outgoing_head += 1
+            # Once all the queued messages are sent, drop them. Only
+            # the sent ones are deleted, so a message queued meanwhile
+            # by a scheduled send() is preserved.
+            if self.outgoing_head == len(self.outgoing):
+                del self.outgoing[:self.outgoing_head]
+                self.outgoing_head = 0
             request = self.build_post_request("sendMessage",oldest)
 
         # Issue a new getUpdates request if there is not
         # some request still pending.
         else:
-            # Limit the fetch to a single message since we are using
-            # a fixed 4k buffer. Very large incoming messages will break
-            # the reading loop: that's a trade off.
-            request = "GET /bot"+self.token+"/getUpdates?offset="+str(self.offset)+"&timeout=0&allowed_udpates=message&limit=1 HTTP/1.1\r\nHost:api.telegram.org\r\n\r\n"
+            # Limit the fetch to a few messages since the read buffer
+            # can grow at most to rbuf_max bytes. If the reply does not
+            # fit, rbuf_overflow() retries fetching a single update, and
+            # skips it if even that is too large: that's a trade off.
+            request = self.get_updates_fmt % (self.offset,self.updates_limit)
 
         # Write the request to the SSL socket.
         #
@@ -114,6 +162,15 @@ class TelegramBot:
     # and if needed ivoke the callback registered by the user for
     # incoming messages.
     def read_api_response(self):
+        # If the buffer is full, and we still don't have a complete
+        # reply, make it larger, up to rbuf_max.
+        if self.rbuf_used == len(self.rbuf):
+            if len(self.rbuf) < self.rbuf_max:
+                self.grow_rbuf(min(len(self.rbuf)*2,self.rbuf_max))
+            else:
+                self.rbuf_overflow()
+                return
+
         try:
             # Don't use await to read from the SSL socket (it's not
             # supported). We put the socket in non blocking mode
@@ -135,21 +192,95 @@ class TelegramBot:
         # Check if we got a well-formed JSON message.
         self.process_api_response()
 
+    # Replace the read buffer with a larger one of 'size' bytes,
+    # preserving the data read so far. The surrogate pairs conversion
+    # buffer must be as large as the read buffer, so it grows as well.
+    def grow_rbuf(self,size):
+        if self.debug: print("[telegram] Growing read buffer to",size)
+        newbuf = bytearray(size)
+        newbuf[:self.rbuf_used] = self.rbuf_mv[:self.rbuf_used]
+        self.rbuf = newbuf
+        self.rbuf_mv = memoryview(newbuf)
+        self.sur_buf = bytearray(size)
+
+    # Called when the reply does not fit in rbuf_max bytes. The rest
+    # of the reply is still in the socket, so we have to reconnect
+    # anyway. If we asked for multiple updates, ask again for a single
+    # one, that may fit. If even a single update is too large, skip it
+    # by moving the offset past its update_id, otherwise we would
+    # request it again forever.
+    def rbuf_overflow(self):
+        if self.debug: print("[telegram] Reply too large for read buffer")
+        if self.updates_limit > 1:
+            self.updates_limit = 1
+        else:
+            i = self.rbuf.find(b'"update_id":',0,self.rbuf_used)
+            if i != -1:
+                i += 12 # Skip the field name.
+                j = self.rbuf.find(b",",i,self.rbuf_used)
+                try:
+                    self.offset = int(bytes(self.rbuf_mv[i:j]))+1
+                    print("[telegram] Skipping too large update",self.offset-1)
+                except ValueError:
+                    pass
+        self.rbuf_used = 0
+        self.reconnect = True
+
+    # Return the value of the Content-Length header of the reply in
+    # the read buffer, whose header ends at 'hdr_end'. If the header
+    # is missing or invalid, None is returned.
+    def get_content_length(self,hdr_end):
+        i = self.rbuf.find(b"Content-Length:",0,hdr_end)
+        if i == -1: return None
+        i += 15 # Skip the field name.
+        j = self.rbuf.find(b"\r\n",i,hdr_end+2)
+        try:
+            return int(bytes(self.rbuf_mv[i:j]))
+        except ValueError:
+            return None
+
     # Check if there is a well-formed JSON reply in the reply buffer:
     # if so, parses it, marks the current request as no longer "pending"
     # and resets the buffer. If the JSON reply is an incoming message, the
     # user callback is invoked.
     def process_api_response(self):
         if self.rbuf_used > 0:
-            # Discard the HTTP request header by looking for the
-            # start of the json message.
-            start_idx = self.rbuf.find(b"{")
+            # Discard the HTTP reply header by looking for the empty
+            # line terminating it: the JSON message starts after it.
+            # Looking for the first "{" would break if some header
+            # contained such character.
+            start_idx = self.rbuf.find(b"\r\n\r\n",0,self.rbuf_used)
             if start_idx != -1:
+                # If the reply has a Content-Length header, don't try
+                # to parse the body until it was fully received: the
+                # JSON parser would just fail after doing its work.
+                body_len = self.get_content_length(start_idx)
+                start_idx += 4
+                if body_len != None and self.rbuf_used-start_idx < body_len:
+                    return
+
+                # Most getUpdates polls return no new message. Detect
+                # such replies without parsing the JSON. There is
+                # nothing after the empty result, so if we can find it
+                # the reply is complete.
+                if self.rbuf.find(b'"result":[]}',start_idx,self.rbuf_used) != -1:
+                    if self.debug: print("No more messages.")
+                    self.pending = False
+                    self.rbuf_used = 0
+                    return
+
                 # It is possible that we read a non complete reply
                 # from the socket. In such case the JSON message
                 # will be broken and will produce a ValueError.
+                #
+                # Surrogate pairs conversion is only needed if there
+                # are \u escapes at all: usually there are none, and
+                # we can parse the read buffer directly.
                 try:
-                    mybuf = self.decode_surrogate_pairs(self.rbuf[start_idx:self.rbuf_used])
+                    if self.rbuf.find(b'\\u',start_idx,self.rbuf_used) == -1:
+                        mybuf = self.rbuf_mv[start_idx:self.rbuf_used]
+                    else:
+                        mybuf = self.decode_surrogate_pairs(self.rbuf,start_idx,self.rbuf_used)
                     res = json.loads(mybuf)
                 except ValueError:
                     res = False
@@ -167,97 +298,140 @@ class TelegramBot:
                     else:
                         # Update the last message ID we get so we
                         # will get only next ones.
-                        offset = res['result'][0]['update_id']
-                        offset += 1
-                        self.offset = offset
-                        if self.debug: print("New offset:",offset)
-
-                        # Process the received message.
-                        entry = res['result'][0]
-                        if "message" in entry:
-                            msg = entry['message']
-                        elif "channel_post" in entry:
-                            msg = entry['channel_post']
-
-                        # Fill the fields depending on the message
-                        msg_type = None
-                        chat_name = None
-                        sender_name = None
-                        chat_id = None
-                        text = None
-
-                        try: msg_type = msg['chat']['type']
-                        except: pass
-                        try: chat_name = msg['chat']['title']
-                        except: pass
-                        try: sender_name = msg['from']['username']
-                        except: pass
-                        try: chat_id = msg['chat']['id']
-                        except: pass
-                        try: text = msg['text']
-                        except: pass
-
-                        # We don't care about join messages and other stuff.
-                        # We report just messages with some text content.
-                        if text != None:
-                            self.callback(self,msg_type,chat_name,sender_name,chat_id,text,entry)
+                        self.offset = res['result'][-1]['update_id']+1
+                        if self.debug: print("New offset:",self.offset)
+                        # The reply fit: go back fetching a few
+                        # updates at a time, if we were fetching one.
+                        self.updates_limit = 4
+
+                        # Process all the received messages.
+                        for entry in res['result']:
+                            self.process_update(entry)
                     self.rbuf_used = 0
 
+    # Process a single update entry of a getUpdates reply, calling the
+    # user callback if it is a message with some text.
+    def process_update(self,entry):
+        if "message" in entry:
+            msg = entry['message']
+        elif "channel_post" in entry:
+            msg = entry['channel_post']
+        else:
+            return
+
+        # Fill the fields depending on the message
+        msg_type = None
+        chat_name = None
+        sender_name = None
+        chat_id = None
+        text = None
+
+        try: msg_type = msg['chat']['type']
+        except: pass
+        try: chat_name = msg['chat']['title']
+        except: pass
+        try: sender_name = msg['from']['username']
+        except: pass
+        try: chat_id = msg['chat']['id']
+        except: pass
+        try: text = msg['text']
+        except: pass
+
+        # We don't care about join messages and other stuff.
+        # We report just messages with some text content.
+        if text != None:
+            self.callback(self,msg_type,chat_name,sender_name,chat_id,text,entry)
+
     # MicroPython seems to lack the urlencode module. We need very
     # little to kinda make it work.
+    #
+    # Each byte is mapped to its quoted form with a lookup table of
+    # 256 strings, so that no formatting is needed for each byte.
+    # The table is created on first use, to avoid wasting memory if
+    # the bot never sends messages.
+    quote_table = None
+
     def quote(self,string):
-        return ''.join(['%{:02X}'.format(c) if c < 33 or c > 126 or c in (37, 38, 43, 58, 61) else chr(c) for c in str(string).encode('utf-8')])
+        table = TelegramBot.quote_table
+        if table == None:
+            table = tuple(['%{:02X}'.format(c) if c < 33 or c > 126 or c in (37, 38, 43, 58, 61) else chr(c) for c in range(256)])
+            TelegramBot.quote_table = table
+        return ''.join([table[c] for c in str(string).encode('utf-8')])
 
     # Turn the GET/POST parameters in the 'fields' hash into a string
     # in url encoded form a=1&b=2&... quoting just the value (the key
     # of the hash is assumed to be already url encoded or just a plain
     # string without special chars).
+    #
+    # Integer values (like chat_id) never need quoting.
     def urlencode(self,fields):
-        return "&".join([str(key)+"="+self.quote(value) for key,value in fields.items()])
+        return "&".join([str(key)+"="+(str(value) if isinstance(value,int) else self.quote(value)) for key,value in fields.items()])
 
     # Create a POST request with url-encoded parameters in the body.
     # Parameters are passed as a hash in 'fields'.
+    #
+    # The request headers only change with the command and the
+    # content length, so the part before the length is cached for
+    # each command.
     def build_post_request(self,cmd,fields):
         params = self.urlencode(fields)
-        headers = f"POST /bot{self.token}/{cmd} HTTP/1.1\r\nHost:api.telegram.org\r\nContent-Type:application/x-www-form-urlencoded\r\nContent-Length:{len(params)}\r\n\r\n"
-        return headers+params
+        prefix = self.post_prefix.get(cmd)
+        if prefix == None:
+            prefix = f"POST /bot{self.token}/{cmd} HTTP/1.1\r\nHost:api.telegram.org\r\nContent-Type:application/x-www-form-urlencoded\r\nContent-Length:"
+            self.post_prefix[cmd] = prefix
+        return prefix+str(len(params))+"\r\n\r\n"+params
 
     # MicroPython JSON library does not handle surrogate UTF-16 pairs
     # generated by the Telegram API. We need to do it manually by scanning
     # the input bytearray and converting the surrogates to UTF-8.
-    def decode_surrogate_pairs(self,ba):
-        result = bytearray()
-        i = 0
-        while i < len(ba):
-            if ba[i:i+2] == b'\\u' and i + 12 <= len(ba):
-                if ba[i+2:i+4] in [b'd8', b'd9', b'da', b'db'] and ba[i+6:i+8] == b'\\u' and ba[i+8:i+10] in [b'dc', b'dd', b'de', b'df']:
-                    # We found a surrogate pairs. Convert.
-                    high = int(ba[i+2:i+6].decode(), 16)
-                    low = int(ba[i+8:i+12].decode(), 16)
-                    code_point = 0x10000 + (high - 0xD800) * 0x400 + (low - 0xDC00)
-                    result.extend(chr(code_point).encode('utf-8'))
-                    i += 12
-                else:
-                    result.append(ba[i])
-                    i += 1
-            else:
-                result.append(ba[i])
-                i += 1
-        return result
+    #
+    # The bytes of 'ba' from 'start' to 'end' are converted into the
+    # preallocated self.sur_buf (the output is never longer than the
+    # input), and a memoryview of the converted data is returned.
+    def decode_surrogate_pairs(self,ba,start,end):
+        result = self.sur_buf
+        i = start
+        j = 0 # Write position inside the result buffer.
+        while i < end:
+            c = ba[i]
+            # Look for "\uD[89AB]..\uD[CDEF]..", comparing single bytes
+            # as integers to avoid allocating slices: 0x5c 0x75 is "\u",
+            # and "|0x20" turns hex letters lowercase, leaving digits
+            # unchanged.
+            if c == 0x5c and i + 12 <= end and ba[i+1] == 0x75 and \
+               ba[i+2]|0x20 == 0x64 and ba[i+3]|0x20 in (0x38,0x39,0x61,0x62) and \
+               ba[i+6] == 0x5c and ba[i+7] == 0x75 and \
+               ba[i+8]|0x20 == 0x64 and 0x63 <= ba[i+9]|0x20 <= 0x66:
+                # We found a surrogate pairs. Convert.
+                high = int(ba[i+2:i+6].decode(), 16)
+                low = int(ba[i+8:i+12].decode(), 16)
+                code_point = 0x10000 + (high - 0xD800) * 0x400 + (low - 0xDC00)
+                utf8 = chr(code_point).encode('utf-8')
+                result[j:j+len(utf8)] = utf8
+                j += len(utf8)
+                i += 12
+                continue
+            result[j] = c
+            j += 1
+            i += 1
+        return memoryview(result)[:j]
 
     # Send a message via Telegram, to the specified chat_id and containing
     # the specified text. This function will just queue the item. The
     # actual sending will be performed in the main boot loop.
     #
     # If 'glue' is True, the new text will be glued to the old pending
-    # message up to 2k, in order to reduce the API back-and-forth.
+    # message up to 2k, in order to reduce the API back-and-forth. This
+    # only happens if the pending message is for the same chat.
     def send(self,chat_id,text,glue=False):
-        if glue and len(self.outgoing) > 0 and \
-           len(self.outgoing[0]["text"])+len(text)+1 < 2048:
-            self.outgoing[0]["text"] += "\n"
-            self.outgoing[0]["text"] += text
+        if glue and len(self.outgoing) > self.outgoing_head and \
+           self.outgoing[-1]["chat_id"] == chat_id and \
+           len(self.outgoing[-1]["text"])+len(text)+1 < 2048:
+            self.outgoing[-1]["text"] += "\n"
+            self.outgoing[-1]["text"] += text
             return
-        self.outgoing = [{"chat_id":chat_id, "text":text}]+self.outgoing
+        self.outgoing.append({"chat_id":chat_id, "text":text})
+        self.outgoing_flag.set()
 
     # This is just a utility method that can be used in order to wait
     # for the WiFi network to be connected.
@@ -18,15 +18,22 @@ class NodesListView:
         self.page = 0 # At each refresh, a different page is shown.
         self.page_change_time = None # Set at first refresh & page change.
         self.items_per_page = None # Will be set after the first refresh.
+        self.nodes = None # Snapshot of the neighbors, taken at page change.
 
     def refresh(self):
         if not self.display: return
         if self.page_change_time == None:
             self.page_change_time = time.ticks_ms()
 
-        self.display.fill(0)
-        self.display.text("Nodes seen",0,0,1)
-        self.display.line(0,10,self.display.width-1,10,1)
+        # Avoid looking up the display and its attributes many
+        # times in the rendering loop.
+        display = self.display
+        width = display.width
+        height = display.height
+
+        display.fill(0)
+        display.text("Nodes seen",0,0,1)
+        display.line(0,10,width-1,10,1)
         neigh = self.fw.neighbors
 
         # Select next page at each refresh. Wrap around when
@@ -37,25 +44,33 @@ class NodesListView:
             if self.page * self.items_per_page >= len(neigh):
                 self.page = 0
             self.page_change_time = time.ticks_ms()
-        print("page",self.page)
+            self.nodes = None
+
+        # Take a snapshot of the nodes as a list at every page change,
+        # so that we can jump directly to the items of the current
+        # page, instead of scanning the neighbors dictionary from
+        # the start at every refresh.
+        if self.nodes == None: self.nodes = list(neigh.values())
 
         # Render the list of nodes for this page.
         y = 12
-        item_id = 0
-        for node_id, m in neigh.items():
-            # Only show items belonging to this page.
-            if self.items_per_page == None or \
-               item_id >= self.page*self.items_per_page:
-                self.display.text(f"{item_id+1} {m.nick}({m.seen})",0,y,1)
-                y += 8
-                if y+7 >= self.display.height: break
+        if self.items_per_page == None:
+            item_id = 0
+            page_nodes = self.nodes
+        else:
+            item_id = self.page*self.items_per_page
+            page_nodes = self.nodes[item_id:item_id+self.items_per_page]
+        for m in page_nodes:
+            display.text(f"{item_id+1} {m.nick}({m.seen})",0,y,1)
+            y += 8
+            if y+7 >= height: break
             item_id += 1
-        self.display.contrast(255)
-        self.display.show()
+        display.contrast(255)
+        display.show()
 
         # Set the items_per_page if this is the first refresh.
         if self.items_per_page == None:
-            while y+7 < self.display.height: # Virtually reach end of screen.
+            while y+7 < height: # Virtually reach end of screen.
                 y += 8
                 item_id += 1
             self.items_per_page = item_id + 1